@@ -6,13 +6,14 @@ Features (core):
 - Multi-user accounts (simple REST create/list)
 - Group chats
 - Send messages (text + optional image_url) with timestamp stored in DB
+- Bulk-send many messages in a single transaction
 - Query chat history by group, by user, by time range
 - Vanna Agent server (Text-to-SQL via RunSqlTool) connected to the same SQLite DB
 
 Run:
-  pip install fastapi uvicorn vanna
+  pip install -r requirements.txt
   export DEEPSEEK_API_KEY="your_key"
-  python app.py
+  python app.py          # WEB_CONCURRENCY=N for N workers (REST only, see entrypoint)
 
 Then:
   - REST docs: http://127.0.0.1:8000/docs
@@ -21,16 +22,29 @@ Then:
 
 from __future__ import annotations
 
+import asyncio
+import contextvars
+import functools
+import hashlib
 import os
+import queue
 import sqlite3
-from typing import Optional, List
-
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional, List
+
+import orjson
+from cachetools import LRUCache, TTLCache
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field, StrictStr, model_validator
 
 # ---- Vanna imports (based on your snippet) ----
 from vanna import Agent, AgentConfig
 from vanna.core.registry import ToolRegistry
+from vanna.core.system_prompt import DefaultSystemPromptBuilder
 from vanna.core.user import UserResolver, User, RequestContext
 from vanna.tools import RunSqlTool, VisualizeDataTool
 from vanna.integrations.sqlite import SqliteRunner
@@ -43,7 +57,42 @@ from vanna.integrations.openai import OpenAILlmService
 from fastapi.middleware.cors import CORSMiddleware
 
 
-DB_PATH = "./demo_chat_app.sqlite"
+@dataclass(frozen=True)
+class Settings:
+    """All configuration, read once at import time and never mutated."""
+    db_path: str = "./demo_chat_app.sqlite"
+    pool_size: int = 10       # read-write connections kept open per process
+    read_pool_size: int = 10  # read-only connections for GET endpoints
+    pool_timeout: float = 30  # seconds to wait for a free connection
+    maintenance_interval: float = 600  # seconds between PRAGMA optimize / WAL checkpoints
+    chat_cache_size: int = 4096   # memoized Vanna LLM responses (identical payloads)
+    chat_cache_ttl: float = 3600  # seconds before a memoized response is requested again
+    llm_threads: int = 32         # threads for Vanna LLM calls/streams and its SQL tool
+    workers: int = 1              # uvicorn worker processes (python demo_chat_app.py)
+    uds: Optional[str] = None     # serve on this Unix socket instead of TCP, e.g. /tmp/chatapp.sock
+    deepseek_api_key: str = field(default="", repr=False)  # kept out of repr(SETTINGS) and tracebacks
+    deepseek_model: str = "deepseek-chat"  # or "deepseek-reasoner"
+    deepseek_base_url: str = "https://api.deepseek.com/v1"
+
+
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        print(f"[WARN] {name}={raw!r} is not an integer; using {default}.")
+        return default
+
+
+SETTINGS = Settings(
+    deepseek_api_key=os.getenv("DEEPSEEK_API_KEY", "").strip(),
+    workers=max(1, _env_int("WEB_CONCURRENCY", 1)),
+    uds=os.getenv("CHAT_UDS", "").strip() or None,
+)
+
+MAX_BULK_MESSAGES = 500
 
 
 # =========================================================
@@ -80,36 +129,232 @@ CREATE TABLE IF NOT EXISTS messages (
   user_id INTEGER NOT NULL,
   content TEXT,            -- nullable if only image_url
   image_url TEXT,          -- optional
-  created_at TEXT NOT NULL DEFAULT (datetime('now')),
+  created_at INTEGER NOT NULL DEFAULT (unixepoch()),  -- unix epoch seconds (UTC)
   FOREIGN KEY (group_id) REFERENCES groups(id) ON DELETE CASCADE,
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- history is paged by id (keyset), which grows with created_at.
+-- The index carries every column get_messages reads, so paging is an index-only scan.
+CREATE INDEX IF NOT EXISTS idx_messages_group_id_cover
+  ON messages(group_id, id DESC, user_id, created_at, content, image_url);
+-- seek for the legacy before/after time filters (see SQL_FIRST_MESSAGE_ID_SINCE)
 CREATE INDEX IF NOT EXISTS idx_messages_group_time ON messages(group_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, created_at);
 """
 
+# Older DB files stored messages.created_at as TEXT. init_db() wraps
+# SCHEMA_SQL between these two scripts (in one transaction) to rebuild the
+# table with epoch integers.
+MIGRATE_MESSAGES_PRE_SQL = """
+ALTER TABLE messages RENAME TO messages_text_ts;
+DROP INDEX IF EXISTS idx_messages_group_time;
+DROP INDEX IF EXISTS idx_messages_group_id;
+DROP INDEX IF EXISTS idx_messages_group_id_cover;
+DROP INDEX IF EXISTS idx_messages_user_time;
+"""
+
+MIGRATE_MESSAGES_POST_SQL = """
+INSERT INTO messages (id, group_id, user_id, content, image_url, created_at)
+SELECT id, group_id, user_id, content, image_url, unixepoch(created_at)
+FROM messages_text_ts;
+DROP TABLE messages_text_ts;
+"""
 
-def init_db(db_path: str = DB_PATH) -> None:
+# Message timestamps are stored as epoch ints but still returned as
+# "YYYY-MM-DD HH:MM:SS" (UTC) text, so the API shape is unchanged.
+#
+# Hot-path statements live in module constants so every call passes the
+# exact same string and hits sqlite3's per-connection statement cache.
+SQL_GET_USER_ID = "SELECT id FROM users WHERE username = ?"
+SQL_GET_GROUP_ID = "SELECT id FROM groups WHERE name = ?"
+SQL_GET_USERNAME = "SELECT username FROM users WHERE id = ?"
+
+# The membership check is part of the INSERT: no row comes back for non-members.
+SQL_INSERT_MESSAGE = """
+INSERT INTO messages (group_id, user_id, content, image_url)
+SELECT ?1, ?2, ?3, ?4
+WHERE EXISTS (SELECT 1 FROM group_members WHERE group_id = ?1 AND user_id = ?2)
+RETURNING id, group_id, content, image_url, datetime(created_at, 'unixepoch') AS created_at
+"""
+
+# Translates a legacy created_at filter into an id bound: one seek on
+# (group_id, created_at), whose first entry is the oldest id at or after the
+# time. Always returns one row; ts is NULL when the text is not a valid time.
+SQL_FIRST_MESSAGE_ID_SINCE = """
+SELECT t.ts, (
+  SELECT id FROM messages
+  WHERE group_id = ?1 AND created_at >= t.ts
+  ORDER BY created_at ASC, id ASC
+  LIMIT 1
+)
+FROM (SELECT unixepoch(?2) AS ts) t
+"""
+
+# no JOIN to users: usernames come from the in-memory user_id -> username map
+SQL_LIST_MESSAGES_BASE = """
+SELECT m.id, m.group_id, m.user_id, m.content, m.image_url,
+       datetime(m.created_at, 'unixepoch') AS created_at
+FROM messages m
+"""
+
+# One fixed statement per (after_id given, before_id given) combination, so
+# the SQL text is identical across requests and stays in the statement cache.
+SQL_LIST_MESSAGES = {
+    (has_after, has_before): SQL_LIST_MESSAGES_BASE
+    + "WHERE m.group_id = ?"
+    + (" AND m.id > ?" if has_after else "")
+    + (" AND m.id < ?" if has_before else "")
+    + "\nORDER BY m.id DESC\nLIMIT ?"
+    for has_after in (False, True)
+    for has_before in (False, True)
+}
+
+SQL_INSERT_USER = "INSERT INTO users (username) VALUES (?) RETURNING id, username, created_at"
+SQL_INSERT_GROUP = "INSERT INTO groups (name) VALUES (?) RETURNING id, name, created_at"
+
+# OR IGNORE + RETURNING: an existing (group_id, user_id) row yields no result -> 409
+SQL_ADD_MEMBER = """
+INSERT OR IGNORE INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)
+RETURNING role, joined_at
+"""
+
+SQL_INSERT_MESSAGE_ROW = "INSERT INTO messages (group_id, user_id, content, image_url) VALUES (?, ?, ?, ?)"
+
+# Connections return plain tuples (no sqlite3.Row); responses are built
+# with dict(zip(COLS, row)) using these column names.
+USER_COLS = ("id", "username", "created_at")
+GROUP_COLS = ("id", "name", "created_at")
+MEMBER_COLS = ("group_name", "username", "role", "joined_at")
+MESSAGE_COLS = ("id", "group_id", "username", "content", "image_url", "created_at")
+
+STATEMENT_CACHE_SIZE = 256  # sqlite3 default is 128
+
+
+def init_db(db_path: str = SETTINGS.db_path) -> None:
     """
     Creating an 'empty' SQLite DB is equivalent to creating/opening the file.
     Then we apply schema. Safe to call on every startup.
     """
     conn = sqlite3.connect(db_path)
     try:
-        conn.executescript(SCHEMA_SQL)
+        cols = {r[1]: r[2] for r in conn.execute("PRAGMA table_info(messages)")}
+        if cols.get("created_at", "").upper() == "TEXT":
+            conn.executescript(
+                f"BEGIN;\n{MIGRATE_MESSAGES_PRE_SQL}\n{SCHEMA_SQL}\n{MIGRATE_MESSAGES_POST_SQL}\nCOMMIT;"
+            )
+        else:
+            conn.executescript(SCHEMA_SQL)
+        # WAL lets readers run alongside a writer. journal_mode is stored in
+        # the DB file, so it sticks for later connections.
+        conn.execute("PRAGMA journal_mode = WAL;")
+        # Fresh planner stats (sqlite_stat1) so get_messages keeps seeking on
+        # the right index as tables grow. analysis_limit bounds the cost on big DBs.
+        conn.execute("PRAGMA analysis_limit = 1000;")
+        conn.execute("ANALYZE;")
         conn.commit()
     finally:
         conn.close()
 
 
+def _apply_conn_pragmas(conn: sqlite3.Connection) -> None:
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MB
+    conn.execute("PRAGMA cache_size = -64000;")    # ~64 MB
+    conn.execute("PRAGMA busy_timeout = 5000;")
+
+
 def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    # check_same_thread=False: pooled connections are handed to whichever
+    # worker thread serves the request (one thread at a time).
+    conn = sqlite3.connect(SETTINGS.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.execute("PRAGMA foreign_keys = ON;")
+    # per-connection settings (not persisted in the DB file);
+    # under WAL, synchronous=NORMAL skips the per-commit fsync and is still crash-safe
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    _apply_conn_pragmas(conn)
     return conn
 
 
+def get_ro_conn() -> sqlite3.Connection:
+    """
+    Read-only connection for pure reads. Under WAL these run in parallel with the writer.
+    (No cache=shared: a shared cache would serialize readers on table locks again.)
+    """
+    conn = sqlite3.connect(
+        f"file:{SETTINGS.db_path}?mode=ro",
+        uri=True,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.execute("PRAGMA query_only = 1;")
+    _apply_conn_pragmas(conn)
+    return conn
+
+
+# LIFO so the most recently used (cache-warm) connection is reused first.
+_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=SETTINGS.pool_size)
+_ro_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=SETTINGS.read_pool_size)
+
+
+def init_pool(size: int = SETTINGS.pool_size, read_size: int = SETTINGS.read_pool_size) -> None:
+    """
+    Open connections up front so requests never pay the connect + PRAGMA cost.
+    Call once after init_db() (read-only connections need the DB file to exist).
+    """
+    for _ in range(size):
+        _pool.put(get_conn())
+    for _ in range(read_size):
+        _ro_pool.put(get_ro_conn())
+
+
+def close_pool() -> None:
+    for pool in (_pool, _ro_pool):
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+@contextmanager
+def acquire_conn(readonly: bool = False) -> Iterator[sqlite3.Connection]:
+    """Borrow a pooled connection; pass readonly=True for pure reads."""
+    pool = _ro_pool if readonly else _pool
+    try:
+        conn = pool.get(timeout=SETTINGS.pool_timeout)
+    except queue.Empty:
+        raise HTTPException(status_code=503, detail="Database is busy, try again later")
+    try:
+        yield conn
+    finally:
+        # don't hand a half-finished transaction to the next request
+        # (read-only connections only run autocommit SELECTs)
+        if not readonly and conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+
+def run_maintenance() -> None:
+    """
+    Periodic housekeeping: refresh planner stats for tables whose size changed
+    a lot, and fold the WAL back into the main file so it doesn't keep growing.
+    """
+    with acquire_conn() as conn:
+        conn.execute("PRAGMA analysis_limit = 1000;")
+        conn.execute("PRAGMA optimize;")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+
+async def _maintenance_loop() -> None:
+    while True:
+        await asyncio.sleep(SETTINGS.maintenance_interval)
+        try:
+            await asyncio.to_thread(run_maintenance)
+        except Exception as e:
+            print(f"[WARN] DB maintenance failed: {e}")
+
+
 # =========================================================
 # 2) REST API models
 # =========================================================
@@ -128,8 +373,18 @@ class AddMemberReq(BaseModel):
 
 class SendMessageReq(BaseModel):
     username: str
-    content: Optional[str] = None
-    image_url: Optional[str] = None
+    content: Optional[StrictStr] = None
+    image_url: Optional[StrictStr] = None
+
+    @model_validator(mode="after")
+    def _content_or_image(self) -> "SendMessageReq":
+        # Checked here so FastAPI answers 422 before the handler (and the DB) is reached.
+        # isspace() rejects blank strings without allocating a stripped copy.
+        if not (self.content and not self.content.isspace()) and not (
+            self.image_url and not self.image_url.isspace()
+        ):
+            raise ValueError("Either content or image_url must be provided")
+        return self
 
 
 class MessageOut(BaseModel):
@@ -144,18 +399,87 @@ class MessageOut(BaseModel):
 # =========================================================
 # 3) REST helpers
 # =========================================================
-def get_user_id(conn: sqlite3.Connection, username: str) -> int:
-    row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-    if not row:
+# Usernames / group names are resolved on every message send, so found ids
+# sit in an LRU. Misses are not cached: a name created later (possibly by
+# another worker) is found on the next lookup. The REST API never renames or
+# deletes, but Vanna's SQL tool can; it calls invalidate_name_caches() after
+# every write, and a write that still fails on a foreign key (a stale id from
+# another worker) evicts the names and answers 404. Lookups go through one
+# shared connection so they never wait on the request pool.
+_lookup_conn: Optional[sqlite3.Connection] = None
+_lookup_lock = threading.Lock()
+_user_ids: LRUCache = LRUCache(maxsize=1024)
+_group_ids: LRUCache = LRUCache(maxsize=1024)
+
+
+def _lookup_value(sql: str, key):
+    global _lookup_conn
+    with _lookup_lock:
+        if _lookup_conn is None:
+            _lookup_conn = get_ro_conn()
+        row = _lookup_conn.execute(sql, (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _resolve_id(cache: LRUCache, sql: str, name: str) -> Optional[int]:
+    with _lookup_lock:
+        value = cache.get(name)
+    if value is None:
+        value = _lookup_value(sql, name)
+        if value is not None:
+            with _lookup_lock:
+                cache[name] = value
+    return value
+
+
+def forget_names(group_name: Optional[str] = None, username: Optional[str] = None) -> None:
+    with _lookup_lock:
+        if group_name is not None:
+            _group_ids.pop(group_name, None)
+        if username is not None:
+            _user_ids.pop(username, None)
+
+
+# user_id -> username for the message read path (saves a JOIN per row).
+# Loaded at startup, updated by create_user, and refilled on a miss. The SQL
+# tool can rename or delete users, so invalidate_name_caches() clears it too.
+_usernames: Dict[int, str] = {}
+
+
+def invalidate_name_caches() -> None:
+    """Drop every cached name <-> id mapping; called after writes outside the REST API."""
+    with _lookup_lock:
+        _user_ids.clear()
+        _group_ids.clear()
+        _usernames.clear()
+
+
+def load_usernames() -> None:
+    with acquire_conn(readonly=True) as conn:
+        _usernames.update(conn.execute("SELECT id, username FROM users").fetchall())
+
+
+def username_for(user_id: int) -> Optional[str]:
+    name = _usernames.get(user_id)
+    if name is None:
+        name = _lookup_value(SQL_GET_USERNAME, user_id)
+        if name is not None:
+            _usernames[user_id] = name
+    return name
+
+
+def get_user_id(username: str) -> int:
+    uid = _resolve_id(_user_ids, SQL_GET_USER_ID, username)
+    if uid is None:
         raise HTTPException(status_code=404, detail=f"User not found: {username}")
-    return int(row["id"])
+    return uid
 
 
-def get_group_id(conn: sqlite3.Connection, group_name: str) -> int:
-    row = conn.execute("SELECT id FROM groups WHERE name = ?", (group_name,)).fetchone()
-    if not row:
+def get_group_id(group_name: str) -> int:
+    gid = _resolve_id(_group_ids, SQL_GET_GROUP_ID, group_name)
+    if gid is None:
         raise HTTPException(status_code=404, detail=f"Group not found: {group_name}")
-    return int(row["id"])
+    return gid
 
 
 # =========================================================
@@ -175,9 +499,35 @@ class SimpleUserResolver(UserResolver):
 # =========================================================
 # 5) Build FastAPI + mount Vanna server
 # =========================================================
-init_db(DB_PATH)
+init_db(SETTINGS.db_path)
+
+class OrjsonResponse(JSONResponse):
+    """JSONResponse rendered with orjson (C-coded, much faster on lists of dicts)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pools are opened here rather than at import: uvicorn workers import this
+    # file twice (once as __mp_main__), and only the served copy needs them.
+    init_pool()
+    load_usernames()
+    task = asyncio.create_task(_maintenance_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+        close_pool()
+
 
-app = FastAPI(title="Chat Group App + Vanna", version="1.0.0")
+app = FastAPI(
+    title="Chat Group App + Vanna",
+    version="1.0.0",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -188,41 +538,198 @@ app.add_middleware(
 )
 
 # ---- Build Vanna Agent (same DB) ----
-tools = ToolRegistry()
-tools.register_local_tool(
-    RunSqlTool(sql_runner=SqliteRunner(database_path=DB_PATH)),
-    access_groups=["admin", "user"],
-)
-tools.register_local_tool(VisualizeDataTool(), access_groups=["admin", "user"])
-
-agent_memory = DemoAgentMemory(max_items=1000)
-tools.register_local_tool(SaveQuestionToolArgsTool(), access_groups=["admin"])
-tools.register_local_tool(SearchSavedCorrectToolUsesTool(), access_groups=["admin", "user"])
-
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY", "").strip()
-if not DEEPSEEK_API_KEY:
+# Built on the first /api/vanna/* request rather than at import, so REST-only
+# workers never pay for (or fail on) the LLM client and tool setup.
+if not SETTINGS.deepseek_api_key:
     # You can still run REST APIs without LLM, but Vanna needs the key to work properly.
     # We'll not crash; we'll warn in logs.
     print("[WARN] DEEPSEEK_API_KEY is empty. Vanna LLM calls may fail.")
 
-llm = OpenAILlmService(
-    api_key=DEEPSEEK_API_KEY,
-    model="deepseek-chat",  # or "deepseek-reasoner"
-    base_url="https://api.deepseek.com/v1",
-)
 
-agent = Agent(
-    llm_service=llm,
-    tool_registry=tools,
-    user_resolver=SimpleUserResolver(),
-    config=AgentConfig(max_tool_iterations=50),
-    agent_memory=agent_memory,
-)
+# Vanna's OpenAILlmService and SqliteRunner are `async def` but call the sync
+# OpenAI client / sqlite3 inside, which blocks the event loop for the whole
+# LLM call. These subclasses run the original coroutine on a worker thread
+# (with its own loop), so other requests and SSE streams keep flowing.
+# The threads come from a dedicated pool: an answer can hold one for the whole
+# stream, and on the default executor (asyncio.to_thread) enough open chats
+# would starve the short SQLite hops of the REST endpoints.
+_llm_executor = ThreadPoolExecutor(max_workers=SETTINGS.llm_threads, thread_name_prefix="vanna")
+
+
+def _run_in_llm_thread(func, *args) -> asyncio.Future:
+    # copy the context like asyncio.to_thread does
+    ctx = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(_llm_executor, ctx.run, func, *args)
+
+
+class ThreadedOpenAILlmService(OpenAILlmService):
+    """
+    Also memoizes LLM responses, keyed on the exact payload sent to the API
+    (model, system prompt, messages, tools). A repeated first turn skips the
+    LLM round-trips whose inputs are unchanged, while tools still run against
+    live data: once a tool returns something new, the next payload differs
+    and goes to the LLM again. (run_sql results name a fresh random CSV file,
+    so calls after a SQL result are in practice always sent.)
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # payload hash -> LlmResponse / list of LlmStreamChunk; only touched from the event loop
+        self._memo: TTLCache = TTLCache(maxsize=SETTINGS.chat_cache_size, ttl=SETTINGS.chat_cache_ttl)
+
+    def _memo_key(self, request, stream: bool) -> str:
+        payload = {**self._build_payload(request), "stream": stream}
+        raw = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    async def send_request(self, request):
+        key = self._memo_key(request, stream=False)
+        cached = self._memo.get(key)
+        if cached is None:
+            cached = await _run_in_llm_thread(asyncio.run, super().send_request(request))
+            self._memo[key] = cached
+        return cached.model_copy(deep=True)
+
+    async def stream_request(self, request):
+        key = self._memo_key(request, stream=True)
+        cached = self._memo.get(key)
+        if cached is not None:
+            for chunk in cached:
+                yield chunk.model_copy(deep=True)
+            return
+
+        captured = []
+        async for chunk in self._stream_in_thread(request):
+            captured.append(chunk.model_copy(deep=True))
+            yield chunk
+        # only reached when the stream ran to its end
+        self._memo[key] = captured
+
+    async def _stream_in_thread(self, request):
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        # set when we stop reading (client gone, error), so the thread stops
+        # pulling the LLM stream instead of buffering it for nobody
+        stop = threading.Event()
+
+        async def pump() -> None:
+            stream = OpenAILlmService.stream_request(self, request)
+            try:
+                async for chunk in stream:
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, (chunk, None))
+            finally:
+                await stream.aclose()
+
+        def run() -> None:
+            try:
+                asyncio.run(pump())
+                loop.call_soon_threadsafe(chunks.put_nowait, (None, None))
+            except BaseException as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, (None, e))
+
+        worker = _run_in_llm_thread(run)
+        try:
+            while True:
+                chunk, err = await chunks.get()
+                if err is not None:
+                    raise err
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            stop.set()
+            await worker
+
+
+class ThreadedSqliteRunner(SqliteRunner):
+    async def run_sql(self, args, context):
+        try:
+            return await _run_in_llm_thread(asyncio.run, super().run_sql(args, context))
+        finally:
+            # SqliteRunner commits anything that is not a SELECT; it may have
+            # renamed or deleted users/groups behind the REST name caches.
+            if args.sql.strip().upper().split()[:1] != ["SELECT"]:
+                invalidate_name_caches()
+
+
+# messages.created_at is an epoch int (see SCHEMA_SQL), but LLM-written SQL
+# usually compares it with datetime('now', ...) text, which in SQLite is never
+# true, or formats it with strftime() directly, which yields NULL. The DDL
+# alone does not stop that, so the agent is told explicitly.
+SQL_SCHEMA_NOTES = """\
+Notes on this SQLite database:
+- messages.created_at is INTEGER unix epoch seconds (UTC). Filter it against
+  unixepoch(...), e.g. created_at >= unixepoch('now', '-7 days'), and format it
+  with datetime(created_at, 'unixepoch') or strftime('%Y-%m', created_at, 'unixepoch').
+  Never compare it with datetime(...) text.
+- users.created_at, groups.created_at and group_members.joined_at are TEXT
+  'YYYY-MM-DD HH:MM:SS' (UTC)."""
+
+
+class ChatAppSystemPromptBuilder(DefaultSystemPromptBuilder):
+    """Vanna's default system prompt followed by SQL_SCHEMA_NOTES."""
+
+    async def build_system_prompt(self, user, tools):
+        prompt = await super().build_system_prompt(user, tools)
+        return f"{prompt}\n\n{SQL_SCHEMA_NOTES}" if prompt else SQL_SCHEMA_NOTES
+
+
+user_resolver = SimpleUserResolver()
+
+
+@functools.lru_cache(maxsize=1)
+def get_agent() -> Agent:
+    tools = ToolRegistry()
+    tools.register_local_tool(
+        RunSqlTool(sql_runner=ThreadedSqliteRunner(database_path=SETTINGS.db_path)),
+        access_groups=["admin", "user"],
+    )
+    tools.register_local_tool(VisualizeDataTool(), access_groups=["admin", "user"])
+
+    agent_memory = DemoAgentMemory(max_items=1000)
+    tools.register_local_tool(SaveQuestionToolArgsTool(), access_groups=["admin"])
+    tools.register_local_tool(SearchSavedCorrectToolUsesTool(), access_groups=["admin", "user"])
+
+    llm = ThreadedOpenAILlmService(
+        api_key=SETTINGS.deepseek_api_key,
+        model=SETTINGS.deepseek_model,
+        base_url=SETTINGS.deepseek_base_url,
+    )
+
+    return Agent(
+        llm_service=llm,
+        tool_registry=tools,
+        user_resolver=user_resolver,
+        config=AgentConfig(max_tool_iterations=50),
+        agent_memory=agent_memory,
+        system_prompt_builder=ChatAppSystemPromptBuilder(),
+    )
+
 
 from vanna.servers.fastapi.routes import register_chat_routes
 from vanna.servers.base import ChatHandler
 
-chat_handler = ChatHandler(agent)
+
+class LazyChatHandler(ChatHandler):
+    """ChatHandler whose agent is created by get_agent() on first use."""
+
+    def __init__(self) -> None:
+        super().__init__(agent=None)  # no agent yet; see the property below
+
+    @property
+    def agent(self) -> Agent:
+        if self._agent is None:
+            self._agent = get_agent()
+        return self._agent
+
+    @agent.setter
+    def agent(self, agent: Optional[Agent]) -> None:
+        self._agent = agent
+
+
+chat_handler = LazyChatHandler()
 
 # 默认会注册类似：
 # - POST /api/vanna/v2/chat_sse
@@ -233,169 +740,217 @@ register_chat_routes(app, chat_handler)
 # =========================================================
 # 6) REST endpoints for chat app
 # =========================================================
+# Read endpoints return OrjsonResponse directly: that skips FastAPI's
+# jsonable_encoder pass over every row.
+
 @app.get("/health")
 def health():
-    return {"ok": True, "db_path": DB_PATH}
+    return {"ok": True, "db_path": SETTINGS.db_path}
 
 
 @app.post("/users")
 def create_user(req: CreateUserReq):
-    conn = get_conn()
-    try:
+    with acquire_conn() as conn:
         try:
-            conn.execute("INSERT INTO users (username) VALUES (?)", (req.username,))
+            row = conn.execute(SQL_INSERT_USER, (req.username,)).fetchone()
             conn.commit()
         except sqlite3.IntegrityError:
             raise HTTPException(status_code=409, detail="Username already exists")
-        row = conn.execute("SELECT id, username, created_at FROM users WHERE username = ?", (req.username,)).fetchone()
-        return dict(row)
-    finally:
-        conn.close()
+        _usernames[row[0]] = row[1]
+        return dict(zip(USER_COLS, row))
 
 
 @app.get("/users")
 def list_users():
-    conn = get_conn()
-    try:
+    with acquire_conn(readonly=True) as conn:
         rows = conn.execute("SELECT id, username, created_at FROM users ORDER BY id ASC").fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+        return OrjsonResponse([dict(zip(USER_COLS, r)) for r in rows])
 
 
 @app.post("/groups")
 def create_group(req: CreateGroupReq):
-    conn = get_conn()
-    try:
+    with acquire_conn() as conn:
         try:
-            conn.execute("INSERT INTO groups (name) VALUES (?)", (req.name,))
+            row = conn.execute(SQL_INSERT_GROUP, (req.name,)).fetchone()
             conn.commit()
         except sqlite3.IntegrityError:
             raise HTTPException(status_code=409, detail="Group name already exists")
-        row = conn.execute("SELECT id, name, created_at FROM groups WHERE name = ?", (req.name,)).fetchone()
-        return dict(row)
-    finally:
-        conn.close()
+        return dict(zip(GROUP_COLS, row))
 
 
 @app.get("/groups")
 def list_groups():
-    conn = get_conn()
-    try:
+    with acquire_conn(readonly=True) as conn:
         rows = conn.execute("SELECT id, name, created_at FROM groups ORDER BY id ASC").fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+        return OrjsonResponse([dict(zip(GROUP_COLS, r)) for r in rows])
 
 
+# The handlers below are async and push all of their DB work into a single
+# asyncio.to_thread() hop, so the event loop stays free while SQLite runs.
 @app.post("/groups/{group_name}/members")
-def add_member(group_name: str, req: AddMemberReq):
-    conn = get_conn()
-    try:
-        gid = get_group_id(conn, group_name)
-        uid = get_user_id(conn, req.username)
+async def add_member(group_name: str, req: AddMemberReq):
+    return await asyncio.to_thread(_add_member_sync, group_name, req)
+
+
+def _add_member_sync(group_name: str, req: AddMemberReq) -> dict:
+    gid = get_group_id(group_name)
+    uid = get_user_id(req.username)
+    with acquire_conn() as conn:
         try:
-            conn.execute(
-                "INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, ?)",
-                (gid, uid, req.role),
-            )
+            row = conn.execute(SQL_ADD_MEMBER, (gid, uid, req.role)).fetchone()
             conn.commit()
         except sqlite3.IntegrityError:
+            # a cached id whose row was deleted behind our back
+            forget_names(group_name, req.username)
+            raise HTTPException(status_code=404, detail="User or group not found")
+        if row is None:
             raise HTTPException(status_code=409, detail="User is already a member of this group")
 
-        row = conn.execute(
-            """
-            SELECT g.name AS group_name, u.username, gm.role, gm.joined_at
-            FROM group_members gm
-            JOIN users u ON u.id = gm.user_id
-            JOIN groups g ON g.id = gm.group_id
-            WHERE gm.group_id = ? AND gm.user_id = ?
-            """,
-            (gid, uid),
-        ).fetchone()
-        return dict(row)
-    finally:
-        conn.close()
+        role, joined_at = row
+        return dict(zip(MEMBER_COLS, (group_name, req.username, role, joined_at)))
 
 
 @app.post("/groups/{group_name}/messages")
-def send_message(group_name: str, req: SendMessageReq):
-    if (req.content is None or req.content.strip() == "") and (req.image_url is None or req.image_url.strip() == ""):
-        raise HTTPException(status_code=400, detail="Either content or image_url must be provided")
+async def send_message(group_name: str, req: SendMessageReq):
+    return await asyncio.to_thread(_send_message_sync, group_name, req)
 
-    conn = get_conn()
-    try:
-        gid = get_group_id(conn, group_name)
-        uid = get_user_id(conn, req.username)
-
-        # ensure membership
-        mem = conn.execute(
-            "SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?",
-            (gid, uid),
-        ).fetchone()
-        if not mem:
+
+def _send_message_sync(group_name: str, req: SendMessageReq) -> dict:
+    gid = get_group_id(group_name)
+    uid = get_user_id(req.username)
+    with acquire_conn() as conn:
+        # membership check, insert and read-back in one statement
+        try:
+            row = conn.execute(SQL_INSERT_MESSAGE, (gid, uid, req.content, req.image_url)).fetchone()
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # a cached id whose row was deleted behind our back (the orphaned
+            # membership row passes the EXISTS guard, the foreign key does not)
+            forget_names(group_name, req.username)
+            raise HTTPException(status_code=404, detail="User or group not found")
+
+        if row is None:
             raise HTTPException(status_code=403, detail="User is not a member of this group")
 
-        conn.execute(
-            "INSERT INTO messages (group_id, user_id, content, image_url) VALUES (?, ?, ?, ?)",
-            (gid, uid, req.content, req.image_url),
-        )
-        conn.commit()
+        msg_id, gid, content, image_url, created_at = row
+        return dict(zip(MESSAGE_COLS, (msg_id, gid, req.username, content, image_url, created_at)))
 
-        row = conn.execute(
-            """
-            SELECT m.id, m.group_id, u.username, m.content, m.image_url, m.created_at
-            FROM messages m
-            JOIN users u ON u.id = m.user_id
-            WHERE m.rowid = last_insert_rowid()
-            """
-        ).fetchone()
-        return dict(row)
-    finally:
-        conn.close()
+
+@app.post("/groups/{group_name}/messages:bulk")
+async def send_messages_bulk(group_name: str, reqs: List[SendMessageReq]):
+    if len(reqs) < 1 or len(reqs) > MAX_BULK_MESSAGES:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {MAX_BULK_MESSAGES} messages")
+
+    return await asyncio.to_thread(_send_messages_bulk_sync, group_name, reqs)
+
+
+def _send_messages_bulk_sync(group_name: str, reqs: List[SendMessageReq]) -> dict:
+    gid = get_group_id(group_name)
+    usernames = list(dict.fromkeys(req.username for req in reqs))  # distinct, keep order
+
+    with acquire_conn() as conn:
+        # resolve every sender + membership in one query
+        placeholders = ", ".join("?" * len(usernames))
+        found = conn.execute(
+            f"""
+            SELECT u.id, u.username, gm.user_id IS NOT NULL AS is_member
+            FROM users u
+            LEFT JOIN group_members gm ON gm.user_id = u.id AND gm.group_id = ?
+            WHERE u.username IN ({placeholders})
+            """,
+            (gid, *usernames),
+        ).fetchall()
+        by_name = {username: (uid, is_member) for uid, username, is_member in found}
+        for username in usernames:
+            if username not in by_name:
+                raise HTTPException(status_code=404, detail=f"User not found: {username}")
+            if not by_name[username][1]:
+                raise HTTPException(status_code=403, detail=f"User is not a member of this group: {username}")
+
+        rows = [(gid, by_name[req.username][0], req.content, req.image_url) for req in reqs]
+        # one transaction -> one commit for the whole batch
+        try:
+            with conn:
+                conn.executemany(SQL_INSERT_MESSAGE_ROW, rows)
+                # we hold the write lock for the whole transaction, so the new ids are contiguous
+                last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        except sqlite3.IntegrityError:
+            # the cached group id's row was deleted behind our back
+            forget_names(group_name)
+            raise HTTPException(status_code=404, detail=f"Group not found: {group_name}")
+
+    return {
+        "group_id": gid,
+        "count": len(rows),
+        "first_id": last_id - len(rows) + 1,
+        "last_id": last_id,
+    }
 
 
 @app.get("/groups/{group_name}/messages", response_model=List[MessageOut])
-def get_messages(
+async def get_messages(
     group_name: str,
     limit: int = 50,
+    before_id: Optional[int] = None,  # keyset paging: only messages with id < before_id
+    after_id: Optional[int] = None,   # only messages with id > after_id
     before: Optional[str] = None,  # ISO-like text, e.g. "2026-01-18 12:00:00"
     after: Optional[str] = None,
 ):
     if limit < 1 or limit > 500:
         raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
 
-    conn = get_conn()
-    try:
-        gid = get_group_id(conn, group_name)
+    rows = await asyncio.to_thread(_get_messages_sync, group_name, limit, before_id, after_id, before, after)
+    # Returning a Response skips response_model validation; MessageOut only documents the shape.
+    return OrjsonResponse(rows)
 
-        where = ["m.group_id = ?"]
-        params = [gid]
 
+def _first_message_id_since(conn: sqlite3.Connection, gid: int, param: str, value: str) -> Optional[int]:
+    ts, first_id = conn.execute(SQL_FIRST_MESSAGE_ID_SINCE, (gid, value)).fetchone()
+    if ts is None:
+        raise HTTPException(status_code=400, detail=f"{param} is not a valid time: {value}")
+    return first_id
+
+
+def _get_messages_sync(
+    group_name: str,
+    limit: int,
+    before_id: Optional[int],
+    after_id: Optional[int],
+    before: Optional[str],
+    after: Optional[str],
+) -> List[dict]:
+    gid = get_group_id(group_name)
+    with acquire_conn(readonly=True) as conn:
+        # Legacy time filters become id bounds once, so the main query is a
+        # pure range scan on (group_id, id).
         if after:
-            where.append("m.created_at >= ?")
-            params.append(after)
+            first_id = _first_message_id_since(conn, gid, "after", after)
+            if first_id is None:
+                return []
+            bound = first_id - 1
+            after_id = bound if after_id is None else max(after_id, bound)
         if before:
-            where.append("m.created_at < ?")
-            params.append(before)
+            first_id = _first_message_id_since(conn, gid, "before", before)
+            if first_id is not None:
+                before_id = first_id if before_id is None else min(before_id, first_id)
 
-        where_sql = " AND ".join(where)
+        params = [gid]
+        if after_id is not None:
+            params.append(after_id)
+        if before_id is not None:
+            params.append(before_id)
+        params.append(limit)
 
-        rows = conn.execute(
-            f"""
-            SELECT m.id, m.group_id, u.username, m.content, m.image_url, m.created_at
-            FROM messages m
-            JOIN users u ON u.id = m.user_id
-            WHERE {where_sql}
-            ORDER BY m.created_at DESC
-            LIMIT ?
-            """,
-            (*params, limit),
-        ).fetchall()
+        sql = SQL_LIST_MESSAGES[(after_id is not None, before_id is not None)]
+        rows = conn.execute(sql, params).fetchall()
 
-        return [MessageOut(**dict(r)) for r in rows]
-    finally:
-        conn.close()
+        out = []
+        for msg_id, gid, uid, content, image_url, created_at in rows:
+            username = username_for(uid)
+            if username is None:
+                continue  # sender deleted behind our back; the old JOIN dropped these rows too
+            out.append(dict(zip(MESSAGE_COLS, (msg_id, gid, username, content, image_url, created_at))))
+        return out
 
 
 # =========================================================
@@ -405,4 +960,23 @@ if __name__ == "__main__":
     # Use uvicorn so everything runs in one server.
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # One worker by default: Vanna's conversation store, agent memory and the
+    # LLM response cache live in process memory, so with several workers a follow-up
+    # turn can land on a worker that has never seen the conversation. Raise
+    # WEB_CONCURRENCY (e.g. to the CPU count) only for REST-heavy use. Each
+    # worker has its own pools; WAL lets them share the DB file. This process
+    # ran init_db() (and any schema migration) above, before any worker
+    # starts; each worker re-runs it on import, which then only re-ANALYZEs.
+    # A single worker is served from this process with the `app` object, so
+    # the module is not imported (and init_db() not run) a second time;
+    # several workers need the import string.
+    # loop/http "auto" pick uvloop + httptools when installed (uvicorn[standard]).
+    uvicorn.run(
+        app if SETTINGS.workers == 1 else f"{os.path.splitext(os.path.basename(__file__))[0]}:app",
+        host="0.0.0.0",
+        port=8000,
+        uds=SETTINGS.uds,
+        workers=SETTINGS.workers,
+        loop="auto",
+        http="auto",
+    )